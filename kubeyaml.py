@@ -1,16 +1,26 @@
 import sys
 import argparse
 import functools
-import collections
-from ruamel.yaml import YAML
+from collections.abc import Mapping as _Mapping
 
 # The container name, by proclamation, used for an image supplied in a
 # FluxHelmRelease
 FHR_CONTAINER = 'chart-image'
 
+# Kinds whose images are found in spec.values rather than a pod spec
+HELMRELEASE_KINDS = frozenset(['FluxHelmRelease', 'HelmRelease'])
+
 class NotFound(Exception):
     pass
 
+def note(s):
+    """Parse an annotation given as key=value; the value may itself
+    contain '='."""
+    k, sep, v = s.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected key=value, got %r' % s)
+    return k, v
+
 def parse_args():
     p = argparse.ArgumentParser()
     subparsers = p.add_subparsers()
@@ -23,10 +33,6 @@ def parse_args():
     image.add_argument('--image', required=True)
     image.set_defaults(func=update_image)
 
-    def note(s):
-        k, v = s.split('=')
-        return k, v
-
     annotation = subparsers.add_parser('annotate', help='update annotations')
     annotation.add_argument('--namespace', required=True)
     annotation.add_argument('--kind', required=True)
@@ -37,6 +43,9 @@ def parse_args():
     return p.parse_args()
 
 def yaml():
+    # Imported here so that --help and argument errors don't pay for
+    # loading ruamel.yaml
+    from ruamel.yaml import YAML
     y = YAML()
     y.explicit_start = True
     y.explicit_end = False
@@ -58,122 +67,126 @@ class AlwaysFalse(object):
         pass
 
 def apply_to_yaml(fn, infile, outfile):
-    # fn :: iterator a -> iterator b
+    # fn :: iterator a -> list b
     y = yaml()
     # Hack to make sure no end-of-document ("...") is ever added
     y.Emitter.open_ended = AlwaysFalse()
     docs = y.load_all(infile)
     y.dump_all(fn(docs), outfile)
 
+def update_first(docs, update):
+    """Call update on each manifest in the stream of docs until it
+    returns True, and return all the docs"""
+    docs = iter(docs)
+    seen = []
+    for doc in docs:
+        seen.append(doc)
+        for m in manifests(doc):
+            if update(m):
+                return seen + list(docs)
+    raise NotFound()
+
 def update_image(args, docs):
     """Update the manifest specified by args, in the stream of docs"""
-    found = False
-    for doc in docs:
-        if not found:
-            for m in manifests(doc):
-                c = find_container(args, m)
-                if c != None:
-                    set_container_image(m, c, args.image)
-                    found = True
-                    break
-        yield doc
-    if not found:
-        raise NotFound()
+    key = spec_key(args)
+    def update(m):
+        if manifest_key(m) != key:
+            return False
+        c = container_named(m, args.container)
+        if c is None:
+            return False
+        set_container_image(m, c, args.image)
+        return True
+
+    return update_first(docs, update)
 
 def update_annotations(spec, docs):
     def ensure(d, *keys):
         for k in keys:
-            try:
-                d = d[k]
-            except KeyError:
+            if k not in d:
                 d[k] = dict()
-                d = d[k]
+            d = d[k]
         return d
 
-    found = False
-    for doc in docs:
-        if not found:
-            for m in manifests(doc):
-                if match_manifest(spec, m):
-                    notes = ensure(m, 'metadata', 'annotations')
-                    for k, v in spec.notes:
-                        if v == '':
-                            try:
-                                del notes[k]
-                            except KeyError:
-                                pass
-                        else:
-                            notes[k] = v
-                    if len(notes) == 0:
-                        del m['metadata']['annotations']
-                    found = True
-                    break
-        yield doc
-    if not found:
-        raise NotFound()
+    key = spec_key(spec)
+    def update(m):
+        if manifest_key(m) != key:
+            return False
+        notes = ensure(m, 'metadata', 'annotations')
+        # Collapse the notes first, so the last value given for a key
+        # wins; an empty value means remove the annotation.
+        updates = dict(spec.notes)
+        notes.update((k, v) for k, v in updates.items() if v != '')
+        for k, v in updates.items():
+            if v == '':
+                notes.pop(k, None)
+        if len(notes) == 0:
+            del m['metadata']['annotations']
+        return True
+
+    return update_first(docs, update)
 
 def manifests(doc):
-    if doc['kind'] == 'List':
-        for m in doc['items']:
-            yield m
-    else:
-        yield doc
+    if doc['kind'].endswith('List') and 'items' in doc:
+        return doc['items']
+    return [doc]
 
-def match_manifest(spec, manifest):
-    try:
-        # NB treat the Kind as case-insensitive
-        if manifest['kind'].lower() != spec.kind.lower():
-            return False
-        if manifest['metadata'].get('namespace', 'default') != spec.namespace:
-            return False
-        if manifest['metadata']['name'] != spec.name:
-            return False
-    except KeyError:
-        return False
-    return True
+# NB treat the Kind as case-insensitive
+def spec_key(spec):
+    return (spec.kind.lower(), spec.namespace, spec.name)
+
+def manifest_key(manifest):
+    kind, meta = manifest.get('kind'), manifest.get('metadata')
+    if kind is None or meta is None:
+        return None
+    return (kind.lower(), meta.get('namespace', 'default'), meta.get('name'))
+
+# Where to find the pod spec, for kinds that don't keep it at the
+# usual place
+PODSPEC_PATHS = {
+    'CronJob': ('spec', 'jobTemplate', 'spec', 'template', 'spec'),
+}
+DEFAULT_PODSPEC_PATH = ('spec', 'template', 'spec')
 
 def podspec(manifest):
-    if manifest['kind'] == 'CronJob':
-        spec = manifest['spec']['jobTemplate']['spec']['template']['spec']
-    else:
-        spec = manifest['spec']['template']['spec']
+    spec = manifest
+    for k in PODSPEC_PATHS.get(manifest['kind'], DEFAULT_PODSPEC_PATH):
+        spec = spec[k]
     return spec
 
 def containers(manifest):
-    if manifest['kind'] in ['FluxHelmRelease', 'HelmRelease']:
+    if manifest['kind'] in HELMRELEASE_KINDS:
         return fluxhelmrelease_containers(manifest)
     spec = podspec(manifest)
     return spec.get('containers', []) + spec.get('initContainers', [])
 
-def find_container(spec, manifest):
-    if not match_manifest(spec, manifest):
-        return None
+def container_named(manifest, name):
     for c in containers(manifest):
-        if c['name'] == spec.container:
+        if c['name'] == name:
             return c
     return None
 
 def set_container_image(manifest, container, image):
-    if manifest['kind'] in ['FluxHelmRelease', 'HelmRelease']:
+    if manifest['kind'] in HELMRELEASE_KINDS:
         set_fluxhelmrelease_container(manifest, container, image)
     else:
         container['image'] = image
 
 def mappings(values):
-    return ((k, values[k]) for k in values if isinstance(values[k], collections.Mapping))
+    return [(k, v) for k, v in values.items() if isinstance(v, _Mapping)]
 
 # There are different ways of interpreting FluxHelmRelease values as
 # images, and we have to sniff to see which to use.
-def fluxhelmrelease_containers(manifest):
-    def get_image(values):
-        image = values['image']
-        if isinstance(image, collections.Mapping) and 'repository' in image and 'tag' in image:
-            values = image
-            image = image['repository']
-        if 'tag' in values and values['tag'] != '':
-            image = '%s:%s' % (image, values['tag'])
-        return image
+def get_fluxhelmrelease_image(values):
+    image = values['image']
+    if isinstance(image, _Mapping) and 'repository' in image and 'tag' in image:
+        values = image
+        image = image['repository']
+    if 'tag' in values and values['tag'] != '':
+        image = '%s:%s' % (image, values['tag'])
+    return image
 
+def fluxhelmrelease_containers(manifest):
     containers = []
     values = manifest['spec']['values']
     # Easiest one: the values section has a key called `image`, which
@@ -182,49 +195,50 @@ def fluxhelmrelease_containers(manifest):
     if 'image' in values:
         containers =  [{
             'name': FHR_CONTAINER,
-            'image': get_image(values),
+            'image': get_fluxhelmrelease_image(values),
         }]
     # Second easiest: if there's at least one dict in values that has
     # a key `image`, then all such dicts are treated as containers,
     # named for their key.
     for k, v in mappings(values):
         if 'image' in v:
-            containers.append({'name': k, 'image': get_image(v)})
+            containers.append({'name': k, 'image': get_fluxhelmrelease_image(v)})
     return containers
 
-def set_fluxhelmrelease_container(manifest, container, replace):
-    def set_image(values):
-        image = values['image']
-        imageKey = 'image'
-
-        if isinstance(image, collections.Mapping) and 'repository' in image and 'tag' in image:
-            values = image
-            imageKey = 'repository'
-
-        if 'tag' in values:
-            im, tag = replace, ''
-            try:
-                segments = replace.split(':')
-                if len(segments) == 2:
-                    im, tag = segments
-                elif len(segments) == 3:
-                    im = ':'.join(segments[:2])
-                    tag = segments[2]
-            except ValueError:
-                pass
-            values[imageKey] = im
-            values['tag'] = tag
-        else:
-            values[imageKey] = replace
+def parse_ref(ref):
+    """Split an image ref into the image name and the tag (which may be
+    empty)."""
+    # A colon before the last slash belongs to a registry host:port,
+    # so only a colon after it can introduce the tag.
+    colon = ref.rfind(':', ref.rfind('/') + 1)
+    if colon == -1:
+        return ref, ''
+    return ref[:colon], ref[colon+1:]
+
+def set_fluxhelmrelease_image(values, replace):
+    image = values['image']
+    imageKey = 'image'
+
+    if isinstance(image, _Mapping) and 'repository' in image and 'tag' in image:
+        values = image
+        imageKey = 'repository'
+
+    if 'tag' in values:
+        im, tag = parse_ref(replace)
+        values[imageKey] = im
+        values['tag'] = tag
+    else:
+        values[imageKey] = replace
 
+def set_fluxhelmrelease_container(manifest, container, replace):
     values = manifest['spec']['values']
     if container['name'] == FHR_CONTAINER and 'image' in values:
-        set_image(values)
+        set_fluxhelmrelease_image(values, replace)
+        return
+    v = values.get(container['name'])
+    if isinstance(v, _Mapping) and 'image' in v:
+        set_fluxhelmrelease_image(v, replace)
         return
-    for k, v in mappings(values):
-        if k == container['name'] and 'image' in v:
-            set_image(v)
-            return
     raise NotFound
 
 def main():
@@ -6,7 +6,9 @@ from hypothesis.strategies import composite
 from ruamel.yaml.compat import StringIO
 import string
 import copy
-import collections
+import collections.abc
+import argparse
+import pytest
 
 def strip(s):
     return s.strip()
@@ -170,9 +172,7 @@ def test_includes_all_containers(man):
     assume(len(spec['initContainers']) > 0)
     for s in ['containers', 'initContainers']:
         for c in spec[s]:
-            arg = Spec.from_resource(man)
-            arg.container = c['name']
-            assert kubeyaml.find_container(arg, man) is not None
+            assert kubeyaml.container_named(man, c['name']) is not None
 
 ## FluxHelmRelease interpretation
 
@@ -253,6 +253,18 @@ def test_set_custom_container_preserves_structure(image_values, noise):
             kubeyaml.set_fluxhelmrelease_container(res, {'name': name}, image)
             assert original == res['spec']['values']
 
+@given(image_names, image_tags)
+def test_parse_ref(name, tag):
+    assert kubeyaml.parse_ref(name) == (name, '')
+    assert kubeyaml.parse_ref(name + ':' + tag) == (name, tag)
+
+def test_note():
+    assert kubeyaml.note('a=b') == ('a', 'b')
+    assert kubeyaml.note('a=') == ('a', '')
+    assert kubeyaml.note('a=b=c') == ('a', 'b=c')
+    with pytest.raises(argparse.ArgumentTypeError):
+        kubeyaml.note('a')
+
 def custom_resource_values(values):
     return strats.builds(destructive_merge, values_noise, values)
 
@@ -295,38 +307,45 @@ class Spec:
 @given(workload_resources)
 def test_match_self(man):
     spec = Spec.from_resource(man)
-    assert kubeyaml.match_manifest(spec, man)
+    assert kubeyaml.manifest_key(man) == kubeyaml.spec_key(spec)
 
 @given(workload_resources, strats.data())
-def test_find_container(man, data):
+def test_container_named(man, data):
     cs = kubeyaml.containers(man)
     assume(len(cs) > 0)
 
-    spec = Spec.from_resource(man)
     ind = data.draw(strats.integers(min_value=0, max_value=len(cs) - 1))
-    spec.container = cs[ind]['name']
-
-    assert kubeyaml.find_container(spec, man) is not None
+    assert kubeyaml.container_named(man, cs[ind]['name']) is not None
 
 @given(documents)
 def test_manifests(doc):
     for man in kubeyaml.manifests(doc):
         assert man['kind'] != 'List'
 
+@given(strats.lists(resources, max_size=6))
+def test_manifests_typed_list(items):
+    doc = {'kind': 'DeploymentList', 'items': items}
+    assert kubeyaml.manifests(doc) == items
+
+@given(ids(['ThingList']))
+def test_manifests_non_list_kind(t):
+    man = resource_from_tuple(t)
+    assert kubeyaml.manifests(man) == [man]
+
 def check_structure(before, after):
     """A helper that checks whether the structure of two values differ, so
     we can see that e.g., setting the image doesn't upset which keys
     and other values are there.
     """
-    if isinstance(before, collections.Mapping):
-        assert isinstance(after, collections.Mapping)
+    if isinstance(before, collections.abc.Mapping):
+        assert isinstance(after, collections.abc.Mapping)
         for k in before:
             assert k in after
             check_structure(before[k], after[k])
         for k in after:
             assert k in before
     else:
-        assert not isinstance(after, collections.Mapping)
+        assert not isinstance(after, collections.abc.Mapping)
 
 @given(workload_resources, images_with_tag | image_names, strats.data())
 def test_image_update(man, image, data):
@@ -344,7 +363,7 @@ def test_image_update(man, image, data):
         man2 = out
 
     assert man2 is not None
-    assert kubeyaml.match_manifest(args, man2)
+    assert kubeyaml.manifest_key(man2) == kubeyaml.spec_key(args)
     outcs = kubeyaml.containers(man2)
     assert len(outcs) == len(cs)
     assert outcs[ind]['image'] == image
@@ -454,11 +473,12 @@ def test_update_image_apply(docs, data):
     updateds = [man for doc in updateddocs for man in kubeyaml.manifests(doc)]
     assert(len(originals) == len(updateds))
 
+    key = kubeyaml.spec_key(spec)
     found = False
     for i in range(len(originals)):
-        if kubeyaml.match_manifest(spec, updateds[i]):
+        if kubeyaml.manifest_key(updateds[i]) == key:
             assert not found, "spec matched more than one manifest"
-            c = kubeyaml.find_container(spec, updateds[i])
+            c = kubeyaml.container_named(updateds[i], spec.container)
             assert c is not None
             assert c['image'] == spec.image
             found = True